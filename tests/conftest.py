@@ -0,0 +1,28 @@
+def pytest_addoption(parser):
+    """
+    Register the command line options that are specific to integration tests.
+
+    Args:
+        parser: The pytest parser to add the options to.
+    """
+    parser.addoption(
+        '--corpora-test-skip-hash',
+        action='store_true',
+        default=False,
+        help='Assume that corpora which are already in the cache are valid, '
+        'rather than hashing their contents. This speeds up repeated local '
+        'runs, but a corrupted or modified cache will not be detected.')
+
+
+def pytest_configure(config):
+    """
+    Apply the command line options once, before any tests are collected.
+
+    Args:
+        config: The pytest config object holding the parsed options.
+    """
+    # The corpora module is only imported when the option needs it, so that
+    # unit test runs do not need the integration test dependencies.
+    if config.getoption('corpora_test_skip_hash'):
+        from tests.int import test_corpora
+        test_corpora._skip_hash = True
@@ -1,84 +1,276 @@
+import collections
+from concurrent import futures
 import hashlib
+import json
 import logging
-import operator
+import mmap
 import os
 from pathlib import Path
+import shutil
 import tarfile
+import tempfile
+import threading
+import time
 from urllib import parse
 
 import pytest
 import requests
+from requests import adapters
+import urllib3
+
+try:
+    # ISA-L's gzip is a faster drop in replacement for the standard library's,
+    # and is used to decompress the corpora when it is installed.
+    from isal import igzip as gzip
+    from isal.isal_zlib import error as zlib_error
+except ImportError:
+    import gzip
+    from zlib import error as zlib_error
 
 import pyconll
 from .workflow import conditional as _if, fail, partial, pipe, sequence, value
 
+# All corpora are downloaded from the same host, so one session is shared to
+# reuse its connections across the HEAD request, the ranged GETs of a resumed
+# download, and the different corpora in a test run. Retries are already
+# handled by download_file, so the adapter itself does not retry.
+_SESSION = requests.Session()
+_SESSION.mount(
+    'https://',
+    adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=0))
+
+# The connect and read timeouts, in seconds, for requests to the corpora host.
+# Without them, a stalled kept-alive connection would hang a download forever
+# rather than failing the attempt so that it can be resumed.
+_TIMEOUT = (5, 60)
+
+# Set from the --corpora-test-skip-hash option when pytest is configured.
+# When set, existing fixture paths are assumed valid without being hashed.
+_skip_hash = False
+
+# The contents of each hash cache file that has been used in this session, by
+# the cache file's path.
+_hash_caches = {}
+
+# Files are read in blocks into a buffer that each thread allocates once and
+# then reuses, rather than into a new bytes object per block.
+_THREAD_BUFFERS = threading.local()
+
 
 def _cross_platform_stable_fs_iter(dir):
     """
-    Provides a stable ordering across platforms over a directory Path.
+    Provides a stable ordering across platforms over a directory's entries.
 
     This allows iteration across filesystems in a consistent way such that case
     sensitivity of the underlying system does not affect how the files are
     iterated.
 
     Args:
-        dir: The Path object that points to the directory to iterate over.
+        dir: The path-like object that points to the directory to iterate over.
 
     Returns:
-        An iterator that goes over the paths in the directory, defined in such a
-        way that is consistent across platforms.
+        A list of the os.DirEntry objects in the directory, ordered in such a
+        way that is consistent across platforms. The entries cache the file
+        type from the directory listing, so checking it needs no extra stat.
     """
     # As this should work across platforms, paths cannot be compared as is, and
-    # the paths must be compared with another in string format. Paths are
-    # ordered by case insensitivity, and then ordered by case within any paths
-    # that are only different by case. There is a double sort because, a simple
-    # case insensitive sort will provide inconsistent results on linux since
-    # iterdir does not provide consistently ordered results.
-    tupled = map(lambda p: (str(p), p), dir.iterdir())
-    by_case = sorted(tupled, key=operator.itemgetter(0))
-    by_case_insensitive = sorted(by_case, key=lambda el: el[0].lower())
+    # the names must be compared with another in string format. Names are
+    # ordered by case insensitivity, and then ordered by case within any names
+    # that are only different by case. Both orderings are in one sort key,
+    # because a simple case insensitive sort will provide inconsistent results
+    # on linux since directory listings are not consistently ordered.
+    with os.scandir(dir) as it:
+        entries = list(it)
+    entries.sort(key=lambda e: (e.name.lower(), e.name))
+
+    return entries
+
+
+def _thread_buffer(block_size):
+    """
+    Provides a buffer that is reused across calls by the current thread.
+
+    Args:
+        block_size: The size of the buffer, in bytes.
+
+    Returns:
+        The bytearray of the given size for the current thread to read into.
+    """
+    buffer = getattr(_THREAD_BUFFERS, 'buffer', None)
+    if buffer is None or len(buffer) != block_size:
+        buffer = bytearray(block_size)
+        _THREAD_BUFFERS.buffer = buffer
+
+    return buffer
+
+
+def _map_file(f):
+    """
+    Memory maps an open file for one sequential read, if it can be mapped.
+
+    Args:
+        f: The file object opened for reading in binary mode.
 
-    only_paths = map(operator.itemgetter(1), by_case_insensitive)
+    Returns:
+        The read only mmap of the whole file, or None if the file cannot be
+        mapped, such as one too large for the address space.
+    """
+    try:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, OverflowError, ValueError):
+        return None
 
-    return only_paths
+    if hasattr(mmap, 'MADV_SEQUENTIAL'):
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+
+    return mm
 
 
 def _add_file_to_hash(hash_obj, path, block_size):
     """
     Helper method in calculating a path's hash to add the hash of a file.
 
+    A file larger than a block is memory mapped, so that all of its contents
+    are hashed in one call straight from the OS page cache. Smaller files, for
+    which mapping costs more than it saves, are read into a reusable buffer. If
+    a large file cannot be mapped, hashlib.file_digest reads it in blocks when
+    available, or otherwise it is also read into the reusable buffer.
+
     Args:
         hash_obj: The object that is able to hash the file contents.
         path: The location of the file.
         block_size: The size of the blocks to read in.
     """
-    with open(str(path), 'rb') as f:
-        buffer = f.read(block_size)
-        while buffer:
-            hash_obj.update(buffer)
-            buffer = f.read(block_size)
+    with open(path, 'rb', buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        mm = _map_file(f) if size > block_size else None
+
+        if mm is not None:
+            with mm:
+                hash_obj.update(mm)
+        elif size > block_size and hasattr(hashlib, 'file_digest'):
+            hashlib.file_digest(f, lambda: hash_obj)
+        else:
+            buffer = _thread_buffer(block_size)
+            view = memoryview(buffer)
+            n = f.readinto(buffer)
+            while n:
+                hash_obj.update(view[:n])
+                n = f.readinto(buffer)
+
+
+def _prefetch_file(path, block_size):
+    """
+    Reads a file through without using its contents.
+
+    This is run ahead of the hashing of the file, so that by the time the file
+    is hashed, its contents are already in the OS page cache.
+
+    Args:
+        path: The location of the file.
+        block_size: The size of the blocks to read in, in bytes.
+    """
+    buffer = _thread_buffer(block_size)
+    with open(path, 'rb', buffering=0) as f:
+        while f.readinto(buffer):
+            pass
+
+
+def _hash_parts(path):
+    """
+    Provides the parts of a path that go into its hash, in hashing order.
+
+    Each entry within a directory is surrounded by its name tag, before and
+    after its own parts. The tree is walked with an explicit stack rather than
+    recursion, so that deep trees do not nest generators.
+
+    Args:
+        path: The location of the file or directory, as a Path or os.DirEntry.
+
+    Returns:
+        An iterator over the parts of the hash. Each part is either the bytes of
+        a name tag, or the path-like location of a file whose contents are to be
+        hashed.
+    """
+    stack = [path]
+    while stack:
+        part = stack.pop()
+        if isinstance(part, bytes):
+            yield part
+        elif part.is_dir():
+            # Children are pushed in reverse so that they are popped in order,
+            # each as its opening tag, its own parts, and then its closing tag.
+            for child in reversed(_cross_platform_stable_fs_iter(part)):
+                tag = child.name.encode(encoding='utf-8', errors='replace')
+                stack.extend((tag, child, tag))
+        else:
+            yield part
 
 
 def _hash_path_helper(hash_obj, path, block_size):
     """
     Helper to wrap the functionality of updating the actual hash object.
 
+    The hash itself is a single stream and must be updated in order, but the
+    reading of the files is not. Files are read ahead by a pool of threads, so
+    that the disk is kept busy while earlier files are being hashed.
+
     Args:
         hash_obj: The object that is able to hash the file contents.
         path: The location of the file.
         block_size: The size of the blocks to read in, in bytes.
     """
-    if path.is_dir():
-        fs_iter = _cross_platform_stable_fs_iter(path)
+    # A single file has nothing to overlap with, so reading it ahead would only
+    # read it twice.
+    if not path.is_dir():
+        _add_file_to_hash(hash_obj, path, block_size)
+        return
 
-        for child in fs_iter:
-            tag = child.name.encode(encoding='utf-8', errors='replace')
+    workers = os.cpu_count() or 1
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        prefetching = 0
 
-            hash_obj.update(tag)
-            _hash_path_helper(hash_obj, child, block_size)
-            hash_obj.update(tag)
-    else:
-        _add_file_to_hash(hash_obj, path, block_size)
+        for part in _hash_parts(path):
+            if isinstance(part, bytes):
+                pending.append((part, None))
+            else:
+                prefetch = executor.submit(_prefetch_file, part, block_size)
+                pending.append((part, prefetch))
+                prefetching += 1
+
+            # Only hash once enough files are being read ahead, so that
+            # prefetching does not run arbitrarily far ahead of the hash.
+            while prefetching > workers:
+                prefetching -= _hash_pending_part(hash_obj, pending,
+                                                  block_size)
+
+        while pending:
+            _hash_pending_part(hash_obj, pending, block_size)
+
+
+def _hash_pending_part(hash_obj, pending, block_size):
+    """
+    Updates the hash with the next part that is pending.
+
+    Args:
+        hash_obj: The object that is able to hash the file contents.
+        pending: The deque of parts that are still to be hashed. Each element is
+            a name tag and None, or a file location and the Future of its
+            prefetch.
+        block_size: The size of the blocks to read in, in bytes.
+
+    Returns:
+        The number of files that were hashed, either 0 or 1.
+    """
+    part, prefetch = pending.popleft()
+    if prefetch is None:
+        hash_obj.update(part)
+        return 0
+
+    prefetch.result()
+    _add_file_to_hash(hash_obj, part, block_size)
+    return 1
 
 
 def hash_path(hash_obj, path, block_size):
@@ -97,6 +289,94 @@ def hash_path(hash_obj, path, block_size):
     return hash_obj.hexdigest()
 
 
+def _path_fingerprint(path):
+    """
+    Summarizes the state of a path on disk without reading any file contents.
+
+    The fingerprint is made of the number of entries, their total size, and the
+    latest modification time under the path. Any ordinary change to the files,
+    like an edit, addition or removal, changes the fingerprint.
+
+    Args:
+        path: The location of the file or directory.
+
+    Returns:
+        The fingerprint as a list of ints, so that it round trips through json.
+    """
+    st = path.stat()
+    count = 1
+    total_size = st.st_size
+    latest_mtime = st.st_mtime_ns
+
+    dirs = [str(path)] if path.is_dir() else []
+    while dirs:
+        with os.scandir(dirs.pop()) as it:
+            for entry in it:
+                st = entry.stat()
+                count += 1
+                total_size += st.st_size
+                latest_mtime = max(latest_mtime, st.st_mtime_ns)
+
+                if entry.is_dir():
+                    dirs.append(entry.path)
+
+    return [count, total_size, latest_mtime]
+
+
+def _hash_path_sha256_cached(p):
+    """
+    Hash a path with SHA256, reusing the last hash if the path is unchanged.
+
+    Hashes are cached in a json file next to the path, keyed by the path's name
+    and stored along with the path's fingerprint at the time it was hashed. As
+    long as the fingerprint still matches, the path is not read again. The
+    json file is read once per session and kept in memory, and is only read
+    again to merge in other sessions' entries when a new hash is written.
+
+    Args:
+        p: The path to hash.
+
+    Returns:
+        The SHA256 hash of the path as a string in hex format.
+    """
+    cache_path = p.parent / '.hash_cache.json'
+    cache = _hash_caches.get(cache_path)
+    if cache is None:
+        try:
+            cache = json.loads(cache_path.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            cache = {}
+        _hash_caches[cache_path] = cache
+
+    fingerprint = _path_fingerprint(p)
+    entry = cache.get(p.name)
+    if entry and entry['fingerprint'] == fingerprint:
+        logging.info('Reusing the cached hash for unchanged %s.', p)
+        return entry['hash']
+
+    s = hash_path(hashlib.sha256(), p, 1 << 20)
+
+    # Other sessions may be using the same cache file, so their entries are
+    # merged in rather than overwritten by this session's copy, and each write
+    # goes through its own temporary file.
+    try:
+        cache.update(json.loads(cache_path.read_text(encoding='utf-8')))
+    except (OSError, ValueError):
+        pass
+    cache[p.name] = {'fingerprint': fingerprint, 'hash': s}
+
+    with tempfile.NamedTemporaryFile('w',
+                                     encoding='utf-8',
+                                     dir=str(cache_path.parent),
+                                     prefix=cache_path.name,
+                                     suffix='.tmp',
+                                     delete=False) as f:
+        json.dump(cache, f)
+    os.replace(f.name, str(cache_path))
+
+    return s
+
+
 def _get_filename_from_url(url):
     """
     For a url that represents a network file, return the filename part.
@@ -114,54 +394,116 @@ def _get_filename_from_url(url):
     return unquoted
 
 
-def download_file(url, dest, chunk_size, attempts):
+def _download_range(url, dest, start, end, length, chunk_size, attempts):
     """
-    Downloads a file from a url, resilient to failures and controlling speed.
+    Downloads a byte range of a url into the same range of a file on disk.
 
     Args:
-        url: The url to download the file from.
-        dest: The location on disk to store the downloaded file to.
+        url: The url to download the bytes from.
+        dest: The location on disk to write the bytes to. It must already exist
+            and be at least end bytes long.
+        start: The offset of the first byte to download.
+        end: The offset one past the last byte to download.
+        length: The total length of the file at the url.
         chunk_size: The size of the file chunks when streaming the download.
-        attempts: The number of failures to be resistant to. Assumes the server
-            can accept ranged requests on download.
-    """
-    head_r = requests.head(url)
-    content_length = int(head_r.headers['Content-Length'])
+        attempts: The number of failures to be resistant to. After each failure
+            the download backs off exponentially, and then resumes from the
+            last byte that was written.
 
+    Returns:
+        True if the entire range was downloaded, and False otherwise.
+    """
     attempt = 0
-    dest_loc = str(dest)
-    byte_loc = 0
-
-    with open(dest_loc, 'wb') as f:
-        while attempt < attempts:
-            with requests.get(url,
-                              headers={'Range': 'bytes={}-'.format(byte_loc)},
-                              stream=True) as r:
-                for chunk in r.iter_content(chunk_size=chunk_size):
-                    f.write(chunk)
-                    f.flush()
-
-            byte_loc = os.stat(dest_loc).st_size
-            if byte_loc >= content_length:
-                break
+    byte_loc = start
+
+    with open(dest, 'r+b') as f:
+        f.seek(start)
+        while byte_loc < end and attempt < attempts:
+            if attempt > 0:
+                time.sleep(min(2**attempt, 60))
+
+            headers = {'Range': 'bytes={}-{}'.format(byte_loc, end - 1)}
+            try:
+                with _SESSION.get(url,
+                                  headers=headers,
+                                  stream=True,
+                                  timeout=_TIMEOUT) as r:
+                    r.raise_for_status()
+
+                    # A server may ignore the Range header and send the whole
+                    # file, which is only usable when the whole file is wanted.
+                    if r.status_code != 206 and (byte_loc, end) != (0, length):
+                        logging.info(
+                            'Range request for %s was answered with status %s.',
+                            url, r.status_code)
+                    else:
+                        r.raw.decode_content = True
+                        shutil.copyfileobj(r.raw, f, chunk_size)
+            except (requests.RequestException,
+                    urllib3.exceptions.HTTPError) as e:
+                logging.info('Download of %s was interrupted at byte %s: %s',
+                             url, f.tell(), e)
+
+            byte_loc = f.tell()
 
             attempt += 1
 
+    return byte_loc >= end
 
-def delete_dir(path):
+
+def download_file(url, dest, chunk_size, attempts, segments):
     """
-    Recursively deletes a directory and all contents within it.
+    Downloads a file from a url, resilient to failures and controlling speed.
+
+    If the server advertises support for ranged requests, the file is split into
+    segments which are downloaded in parallel, each directly to its offset in
+    the destination file.
 
     Args:
-        path: The path to the directory to delete. Must point to a directory.
+        url: The url to download the file from.
+        dest: The location on disk to store the downloaded file to.
+        chunk_size: The size of the file chunks when streaming the download.
+        attempts: The number of failures to be resistant to, per segment.
+            Assumes the server can accept ranged requests on download.
+        segments: The number of segments to download in parallel.
+
+    Raises:
+        RuntimeError: If any segment could not be completely downloaded.
     """
-    for child in path.iterdir():
-        if child.is_file():
-            child.unlink()
-        elif child.is_dir:
-            delete_dir(child)
+    head_r = _SESSION.head(url, allow_redirects=True, timeout=_TIMEOUT)
+    content_length = int(head_r.headers['Content-Length'])
+    if head_r.headers.get('Accept-Ranges') != 'bytes':
+        segments = 1
 
-    path.rmdir()
+    # Reserving the space up front lets the filesystem lay the file out
+    # contiguously, rather than growing it as the segments are written.
+    dest_loc = str(dest)
+    with open(dest_loc, 'wb') as f:
+        f.truncate(content_length)
+        if hasattr(os, 'posix_fallocate') and content_length > 0:
+            try:
+                os.posix_fallocate(f.fileno(), 0, content_length)
+            except OSError:
+                pass
+
+    bounds = [content_length * i // segments for i in range(segments + 1)]
+    ranges = list(zip(bounds, bounds[1:]))
+    with futures.ThreadPoolExecutor(max_workers=segments) as executor:
+        downloads = [
+            executor.submit(_download_range, url, dest_loc, start, end,
+                            content_length, chunk_size, attempts)
+            for start, end in ranges
+        ]
+
+        incomplete = [
+            '{}-{}'.format(start, end - 1)
+            for (start, end), d in zip(ranges, downloads) if not d.result()
+        ]
+
+    if incomplete:
+        raise RuntimeError(
+            'Download of {} to {} did not complete for bytes {}.'.format(
+                url, dest_loc, ', '.join(incomplete)))
 
 
 @partial
@@ -173,8 +515,11 @@ def validate_hash_sha256(p, hash_s):
         p: The path to hash.
         hash_s: The expected hash of the path as a string.
     """
-    if p.exists():
-        s = hash_path(hashlib.sha256(), p, 8192)
+    if p.exists() and _skip_hash:
+        logging.info('Assuming %s is valid since hashing is skipped.', p)
+        return True
+    elif p.exists():
+        s = _hash_path_sha256_cached(p)
         r = s == hash_s
         if r:
             logging.info('Hash for %s matched expected %s.', p, hash_s)
@@ -203,32 +548,54 @@ def clean_subdir(direc, subdir):
     direc.mkdir(exist_ok=True)
 
     p = direc / subdir
-    if not p.exists():
-        p.mkdir()
-    else:
-        delete_dir(p)
-        p.mkdir()
+    if p.exists():
+        shutil.rmtree(str(p))
+    p.mkdir()
 
 
 @partial
-def download_file_to_dir(url, direc):
+def download_file_to_path(url, tmp):
     """
-    Download a file (final name matching the URL) to a specified directory.
+    Download a file to a specified path.
 
     Args:
         url: The url of the file to download
-        direc: The directory to download the file to.
+        tmp: The path to download the file to.
     """
-    tmp = direc / _get_filename_from_url(url)
     if tmp.exists():
         tmp.unlink()
     logging.info('Starting to download %s to %s.', url, tmp)
-    download_file(url, tmp, 16384, 15)
+    download_file(url, tmp, 1 << 20, 15, 4)
     logging.info('Download succeeded to %s.', tmp)
 
     return tmp
 
 
+def _extract_filter(member, path):
+    """
+    Filters tarfile members so that only their data is extracted.
+
+    On top of tarfile's data filter, which rejects unsafe members, this drops
+    the mode and modification time of each member so that no chmod or utime
+    calls are made after it is written. Only the contents are used by the tests.
+
+    Args:
+        member: The TarInfo of the member to extract.
+        path: The directory being extracted to.
+
+    Returns:
+        The TarInfo to extract the member with.
+    """
+    member = tarfile.data_filter(member, path)
+    return member.replace(mode=None, mtime=None, deep=False)
+
+
+# Extraction filters are only available on versions of python with PEP 706.
+_EXTRACT_KWARGS = {
+    'filter': _extract_filter
+} if hasattr(tarfile, 'data_filter') else {}
+
+
 @partial
 def extract_tgz(p, tgz):
     """
@@ -239,8 +606,97 @@ def extract_tgz(p, tgz):
         tgz: The tarfile to extract from.
     """
     logging.info('Extracting tarfile to %s.', p)
-    with tarfile.open(str(tgz)) as tf:
-        tf.extractall(str(p))
+    with open(str(tgz), 'rb') as f, gzip.open(f) as gz:
+        with tarfile.open(fileobj=gz, mode='r|', bufsize=1 << 20) as tf:
+            tf.extractall(str(p), **_EXTRACT_KWARGS)
+
+
+class _HashingReader:
+    """
+    A readable file object that hashes all the bytes read through it.
+    """
+    def __init__(self, raw, hash_obj):
+        """
+        Create a reader that wraps another readable file object.
+
+        Args:
+            raw: The file object to read from.
+            hash_obj: The object that is able to hash the bytes read.
+        """
+        self._raw = raw
+        self.hash_obj = hash_obj
+
+    def read(self, size=-1):
+        """
+        Read and hash bytes from the underlying file object.
+
+        Args:
+            size: The maximum number of bytes to read, or -1 for all of them.
+
+        Returns:
+            The bytes read, which are empty once the end has been reached.
+        """
+        b = self._raw.read(size)
+        self.hash_obj.update(b)
+        return b
+
+    def readinto(self, b):
+        """
+        Read and hash bytes from the underlying file object into a buffer.
+
+        Args:
+            b: The writable buffer to read into.
+
+        Returns:
+            The number of bytes read, which is 0 once the end has been reached.
+        """
+        n = self._raw.readinto(b)
+        self.hash_obj.update(memoryview(b)[:n])
+        return n
+
+
+@partial
+def stream_extract_tgz(p, url, tgz_hash):
+    """
+    Extracts a tarfile to a directory as it is downloaded, without storing it.
+
+    Args:
+        p: The path to extract to.
+        url: The url of the tarfile to download.
+        tgz_hash: The expected SHA256 hash of the tarfile as a string.
+
+    Returns:
+        True if the tarfile was completely extracted and hashed as expected, and
+        False otherwise.
+    """
+    logging.info('Streaming %s to extract to %s.', url, p)
+    try:
+        with _SESSION.get(url, stream=True, timeout=_TIMEOUT) as r:
+            r.raise_for_status()
+            r.raw.decode_content = True
+
+            reader = _HashingReader(r.raw, hashlib.sha256())
+            with gzip.open(reader) as gz:
+                with tarfile.open(fileobj=gz, mode='r|',
+                                  bufsize=1 << 20) as tf:
+                    tf.extractall(str(p), **_EXTRACT_KWARGS)
+
+            # Extraction stops at the end of archive marker, so any padding
+            # after it must still be read to hash the whole tarfile.
+            while reader.read(1 << 20):
+                pass
+    except (requests.RequestException, urllib3.exceptions.HTTPError,
+            tarfile.TarError, gzip.BadGzipFile, EOFError, zlib_error) as e:
+        logging.info('Streaming extraction of %s failed: %s', url, e)
+        return False
+
+    s = reader.hash_obj.hexdigest()
+    if s != tgz_hash:
+        logging.info('The tarfile at %s hashed as %s instead of %s.', url, s,
+                     tgz_hash)
+        return False
+
+    return True
 
 
 def url_zip(entry_id, fixture_cache, contents_hash, zip_hash, url):
@@ -265,7 +721,7 @@ def url_zip(entry_id, fixture_cache, contents_hash, zip_hash, url):
         sequence(
             clean_subdir(fixture_cache, entry_id),
             pipe(
-                download_file_to_dir(url, fixture_cache),
+                download_file_to_path(url, zip_path),
                 extract_tgz(final_path)
             ),
             _if(
@@ -274,6 +730,24 @@ def url_zip(entry_id, fixture_cache, contents_hash, zip_hash, url):
                 fail('Fixture for {} in {} was not able to be properly setup.'.
                     format(url, final_path))))
 
+    # When nothing usable is cached, the tarfile is extracted as it streams in
+    # so it is never written to and read back from disk. The slower download
+    # to disk, which can resume, is only used if streaming does not work out.
+    # Once the streamed tarfile has matched its hash, downloading it again would
+    # only extract the same contents, so a contents mismatch is final.
+    stream = \
+        _if(
+            sequence(
+                clean_subdir(fixture_cache, entry_id),
+                stream_extract_tgz(final_path, url, zip_hash)
+            ),
+            _if(
+                validate_hash_sha256(final_path, contents_hash),
+                value(final_path),
+                fail('Fixture for {} in {} was not able to be properly setup.'.
+                    format(url, final_path))),
+            download)
+
     w = _if(
             validate_hash_sha256(final_path, contents_hash),
             value(final_path),
@@ -286,14 +760,17 @@ def url_zip(entry_id, fixture_cache, contents_hash, zip_hash, url):
                         value(final_path),
                         sequence(
                             zip_path.unlink,
-                            download
+                            stream
                         )
                     )
                 ),
-                download)) # yapf: disable
+                stream)) # yapf: disable
     return w
 
 
+# The location that all corpora fixtures, and their downloads, are cached in.
+_CORPORA_CACHE = Path('tests/int/_corpora_cache')
+
 # This is the registration for the different corpora. It includes an id, and a
 # method of creation as a key-value pair. This registration structure allows
 # for the same corpora to easily be used in different tests which are designed
@@ -304,63 +781,63 @@ def url_zip(entry_id, fixture_cache, contents_hash, zip_hash, url):
 corpora = {
     'UD v2.8':
     url_zip(
-        'UD v2.8', Path('tests/int/_corpora_cache'),
+        'UD v2.8', _CORPORA_CACHE,
         'eb5d8941be917d2cb46677cb575f18dd6218bddec446b428a5b96d96ab44c0cd',
         '95d2f4370dc5fe93653eb36e7268f4ec0c1bd012e51e943d55430f1e9d0d7e05',
         'https://lindat.mff.cuni.cz/repository/xmlui/bitstream/handle/11234/1-3687/ud-treebanks-v2.8.tgz'
     ),
     'UD v2.7':
     url_zip(
-        'UD v2.7', Path('tests/int/_corpora_cache'),
+        'UD v2.7', _CORPORA_CACHE,
         '38e7d484b0125aaf7101a8c447fd2cb3833235cf428cf3c5749128ade73ecee2',
         'ee61f186ac5701440f9d2889ca26da35f18d433255b5a188b0df30bc1525502b',
         'https://lindat.mff.cuni.cz/repository/xmlui/bitstream/handle/11234/1-3424/ud-treebanks-v2.7.tgz'
     ),
     'UD v2.6':
     url_zip(
-        'UD v2.6', Path('tests/int/_corpora_cache'),
+        'UD v2.6', _CORPORA_CACHE,
         'a28fdc1bdab09ad597a873da62d99b268bdfef57b64faa25b905136194915ddd',
         'a462a91606c6b2534a767bbe8e3f154b678ef3cc81b64eedfc9efe9d60ceeb9e',
         'https://lindat.mff.cuni.cz/repository/xmlui/bitstream/handle/11234/1-3226/ud-treebanks-v2.6.tgz'
     ),
     'UD v2.5':
     url_zip(
-        'UD v2.5', Path('tests/int/_corpora_cache'),
+        'UD v2.5', _CORPORA_CACHE,
         '4761846e8c5f7ec7e40a6591f7ef5307ca9e7264da894d05d135514a4ea22a10',
         '5ff973e44345a5f69b94cc1427158e14e851c967d58773cc2ac5a1d3adaca409',
         'https://lindat.mff.cuni.cz/repository/xmlui/bitstream/handle/11234/1-3105/ud-treebanks-v2.5.tgz'
     ),
     'UD v2.4':
     url_zip(
-        'UD v2.4', Path('tests/int/_corpora_cache'),
+        'UD v2.4', _CORPORA_CACHE,
         '000646eb71cec8608bd95730d41e45fac319480c6a78132503e0efe2f0ddd9a9',
         '252a937038d88587842f652669cdf922b07d0f1ed98b926f738def662791eb62',
         'https://lindat.mff.cuni.cz/repository/xmlui/bitstream/handle/11234/1-2988/ud-treebanks-v2.4.tgz'
     ),
     'UD v2.3':
     url_zip(
-        'UD v2.3', Path('tests/int/_corpora_cache'),
+        'UD v2.3', _CORPORA_CACHE,
         '359e1989771268ab475c429a1b9e8c2f6c76649b18dd1ff6568c127fb326dd8f',
         '122e93ad09684b971fd32b4eb4deeebd9740cd96df5542abc79925d74976efff',
         'https://lindat.mff.cuni.cz/repository/xmlui/bitstream/handle/11234/1-2895/ud-treebanks-v2.3.tgz'
     ),
     'UD v2.2':
     url_zip(
-        'UD v2.2', Path('tests/int/_corpora_cache'),
+        'UD v2.2', _CORPORA_CACHE,
         'fa3a09f2c4607e19d7385a5e975316590f902fa0c1f4440c843738fbc95e3e2a',
         'a9580ac2d3a6d70d6a9589d3aeb948fbfba76dca813ef7ca7668eb7be2eb4322',
         'https://lindat.mff.cuni.cz/repository/xmlui/bitstream/handle/11234/1-2837/ud-treebanks-v2.2.tgz'
     ),
     'UD v2.1':
     url_zip(
-        'UD v2.1', Path('tests/int/_corpora_cache'),
+        'UD v2.1', _CORPORA_CACHE,
         '36921a1d8410dc5e22ef9f64d95885dc60c11811a91e173e1fd21706b83fdfee',
         '446cc70f2194d0141fb079fb22c05b310cae9213920e3036b763899f349fee9b',
         'https://lindat.mff.cuni.cz/repository/xmlui/bitstream/handle/11234/1-2515/ud-treebanks-v2.1.tgz'
     ),
     'UD v2.0':
     url_zip(
-        'UD v2.0', Path('tests/int/_corpora_cache'),
+        'UD v2.0', _CORPORA_CACHE,
         '4f08c84bec5bafc87686409800a9fe9b5ac21434f0afd9afe1cc12afe8aa90ab',
         'c6c6428f709102e64f608e9f251be59d35e4add1dd842d8dc5a417d01415eb29',
         'https://lindat.mff.cuni.cz/repository/xmlui/bitstream/handle/11234/1-1983/ud-treebanks-v2.0.tgz'
@@ -426,22 +903,43 @@ def pytest_generate_tests(metafunc):
 
 def test_corpus(corpus, exceptions):
     """
-    Tests a corpus using the fixture path and the glob for files to test.
+    Tests a corpus using the fixture path, testing all .conllu files within.
 
     Args:
         corpus: The path where the corpus is.
         exceptions: A list of paths relative to fixture that are known failures.
     """
-    globs = corpus.glob('**/*.conllu')
+    exception_paths = frozenset(str(corpus / exp) for exp in exceptions)
 
-    for path in globs:
-        is_exp = any(path == corpus / exp for exp in exceptions)
+    treebank_paths = []
+    for root, _, filenames in os.walk(str(corpus)):
+        for filename in filenames:
+            if not filename.endswith('.conllu'):
+                continue
 
-        if is_exp:
-            logging.info('Skipping over %s because it is a known failure.',
-                         path)
-        else:
-            _test_treebank(str(path))
+            path = os.path.join(root, filename)
+            if path in exception_paths:
+                logging.info('Skipping over %s because it is a known failure.',
+                             path)
+            else:
+                treebank_paths.append(path)
+
+    # Each treebank is independent of the others, so they are tested across
+    # processes. Any failure is raised again here with the treebank it came
+    # from, since the worker logs are interleaved.
+    with futures.ProcessPoolExecutor() as executor:
+        tests = [(path, executor.submit(_test_treebank, path))
+                 for path in treebank_paths]
+
+        for path, test in tests:
+            try:
+                test.result()
+            except Exception as e:
+                # Only the first failure is reported, so the treebanks that
+                # have not started yet are not parsed just to be thrown away.
+                for _, pending in tests:
+                    pending.cancel()
+                pytest.fail('{}: {}'.format(path, e))
 
 
 def _test_treebank(treebank_path):
@@ -451,18 +949,12 @@ def _test_treebank(treebank_path):
     Args:
         treebank_path: The path to the treebank file that is to be parsed and written.
     """
-    TMP_OUTPUT_FILE = '__tmp__ud.conllu'
-
     logging.info('Starting to parse %s', treebank_path)
 
     treebank = pyconll.iter_from_file(treebank_path)
 
     # For each sentence write back and make sure to include the proper
-    # newlines between sentences.
-    with open(TMP_OUTPUT_FILE, 'w', encoding='utf-8') as f:
-        for sentence in treebank:
-            f.write(sentence.conll())
-            f.write('\n\n')
-
-    # Clean up afterwards.
-    os.remove(TMP_OUTPUT_FILE)
+    # newlines between sentences. Only the serialization is under test, so the
+    # output is discarded rather than written to disk.
+    with open(os.devnull, 'w', encoding='utf-8', buffering=1 << 20) as f:
+        f.writelines(sentence.conll() + '\n\n' for sentence in treebank)